@@ -0,0 +1,217 @@
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Benchmark suite for py-qaiku.
+
+Starts a QaikuStubServer and measures the Qaiku client end to end
+(ShowMessage, ShowMessages, PostUpdate, timeline walks, conditional
+requests, reply threads, graph crawls) and the QaikuMessage/QaikuUser decode and encode paths. For
+every benchmark it records throughput, p50/p99 latency, allocations and
+the peak RSS, and writes everything to a JSON file that a later run can
+be compared with.
+
+Usage:
+    python benchmarks/harness.py -o before.json
+    python benchmarks/harness.py -o after.json --compare before.json
+    python benchmarks/harness.py --latency 0.02 --only client
+"""
+
+import gc
+import json
+import optparse
+import os
+import platform
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import qaiku
+from stub_server import QaikuStubServer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class Benchmark:
+    """
+    Runs one operation count times and collects the numbers.
+    """
+
+    def __init__(self, name, group, operation, count, items=1):
+        """
+        Args:
+            operation: callable Called with the iteration number.
+            items: int Items handled per call, for the throughput.
+        """
+        self.name = name
+        self.group = group
+        self.operation = operation
+        self.count = count
+        self.items = items
+
+    def Run(self):
+        gc.collect()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        objects = len(gc.get_objects())
+
+        latencies = []
+        started = time.time()
+        for i in range(self.count):
+            t = time.time()
+            self.operation(i)
+            latencies.append(time.time() - t)
+        total = time.time() - started
+
+        result = {'group': self.group,
+                  'calls': self.count,
+                  'seconds': total,
+                  'throughput': self.count * self.items / total,
+                  'p50_ms': Percentile(latencies, 50) * 1000,
+                  'p99_ms': Percentile(latencies, 99) * 1000,
+                  'retained_objects': len(gc.get_objects()) - objects,
+                  'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        if tracemalloc is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            result['allocated_peak_kb'] = peak // 1024
+            tracemalloc.stop()
+        return result
+
+def Percentile(values, percent):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def ClientBenchmarks(server, count):
+    plain = qaiku.Qaiku('benchmark', base_url=server.base_url, coalesce=False)
+    cached = qaiku.Qaiku('benchmark', base_url=server.base_url, coalesce=False,
+                         cache=qaiku.QaikuResponseCache())
+    batch = ['%x' % i for i in range(100)]
+
+    return [
+        Benchmark('ShowMessage', 'client',
+                  lambda i: plain.ShowMessage('%x' % i), count),
+        Benchmark('ShowMessage cached', 'client',
+                  lambda i: cached.ShowMessage('%x' % (i % 10)), count),
+        Benchmark('ShowMessages x100', 'client',
+                  lambda i: plain.ShowMessages(batch, max_in_flight=10),
+                  max(1, count // 50), items=len(batch)),
+        Benchmark('PostUpdate', 'client',
+                  lambda i: plain.PostUpdate('Benchmarking py-qaiku %d' % i), count),
+        Benchmark('GetPublicTimeLine walk', 'client',
+                  lambda i: sum(1 for message in plain.GetPublicTimeLine()),
+                  max(1, count // 50), items=server.page_size * server.pages),
+        Benchmark('GetThread', 'client',
+                  lambda i: len(plain.GetThread('%x' % (server.thread_size - 1))),
+                  max(1, count // 50), items=server.thread_size),
+        Benchmark('QaikuCrawler depth 2', 'client',
+                  lambda i: len(qaiku.QaikuCrawler(plain, depth=2).Crawl(['user%d' % i])),
+                  max(1, count // 100)),
+    ]
+
+def DecodeBenchmarks(server, count):
+    message = server.Message(1)
+    message_json = json.dumps(message)
+    page_json = json.dumps([server.Message(i) for i in range(server.page_size)])
+    user = server.User(1)
+    decoded = qaiku.QaikuMessage.fromJsonString(message_json)
+    decoded_user = qaiku.QaikuUser.fromDict(user)
+    client = qaiku.Qaiku('benchmark')
+    page = client._DecodeMessages(page_json)
+
+    return [
+        Benchmark('QaikuMessage.fromJsonString', 'decode',
+                  lambda i: qaiku.QaikuMessage.fromJsonString(message_json), count * 10),
+        Benchmark('QaikuMessage.fromJsonString lazy', 'decode',
+                  lambda i: qaiku.QaikuMessage.fromJsonString(message_json, lazy=True), count * 10),
+        Benchmark('timeline page decode', 'decode',
+                  lambda i: client._DecodeMessages(page_json), count,
+                  items=server.page_size),
+        Benchmark('QaikuColumns.fromMessages', 'encode',
+                  lambda i: qaiku.QaikuColumns.fromMessages(page), count,
+                  items=server.page_size),
+        Benchmark('QaikuUser.fromDict', 'decode',
+                  lambda i: qaiku.QaikuUser.fromDict(user), count * 10),
+        Benchmark('QaikuMessage.asJsonString', 'encode',
+                  lambda i: decoded.asJsonString(), count * 10),
+        Benchmark('QaikuUser.asJsonString', 'encode',
+                  lambda i: decoded_user.asJsonString(), count * 10),
+    ]
+
+def Compare(results, path):
+    f = open(path)
+    try:
+        previous = json.load(f)['results']
+    finally:
+        f.close()
+
+    print('')
+    print('%-36s %12s %12s %8s' % ('compared with ' + os.path.basename(path),
+                                   'before', 'after', 'change'))
+    for name in sorted(results):
+        if name not in previous:
+            continue
+        before = previous[name]['throughput']
+        after = results[name]['throughput']
+        print('%-36s %12.1f %12.1f %+7.1f%%' % (name, before, after,
+                                                (after - before) / before * 100))
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', dest='count', type='int', default=500,
+                      help='Calls per client benchmark.')
+    parser.add_option('-o', dest='output', default='bench_results.json',
+                      help='Where to write the JSON results.')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='Stub server latency in seconds.')
+    parser.add_option('--page-size', dest='page_size', type='int', default=20)
+    parser.add_option('--text-size', dest='text_size', type='int', default=120)
+    parser.add_option('--no-compress', dest='compress', action='store_false', default=True,
+                      help='Have the stub server send uncompressed responses.')
+    parser.add_option('--only', default=None,
+                      help='Only run one group: client, decode or encode.')
+    parser.add_option('--compare', default=None,
+                      help='A previous results file to compare with.')
+    options, args = parser.parse_args()
+
+    server = QaikuStubServer(latency=options.latency,
+                             page_size=options.page_size,
+                             text_size=options.text_size,
+                             compress=options.compress).Start()
+    try:
+        benchmarks = ClientBenchmarks(server, options.count) + \
+                     DecodeBenchmarks(server, options.count)
+        results = {}
+        print('%-36s %12s %9s %9s %10s' % ('benchmark', 'items/s', 'p50 ms', 'p99 ms', 'rss kB'))
+        for benchmark in benchmarks:
+            if options.only and benchmark.group != options.only:
+                continue
+            result = results[benchmark.name] = benchmark.Run()
+            print('%-36s %12.1f %9.3f %9.3f %10d' % (benchmark.name, result['throughput'],
+                                                     result['p50_ms'], result['p99_ms'],
+                                                     result['peak_rss_kb']))
+    finally:
+        server.Stop()
+
+    report = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'version': qaiku.__VERSION__,
+                       'json_backend': qaiku.GetJsonCodec().name,
+                       'options': options.__dict__},
+              'results': results}
+    f = open(options.output, 'w')
+    try:
+        json.dump(report, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    print('Results written to %s' % options.output)
+
+    if options.compare:
+        Compare(results, options.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Microbenchmark of the JSON backends QaikuJsonCodec can use.
+
+Times decoding and encoding a realistic public timeline page, with and
+without sort_keys, for every backend in qaiku.__JSONBACKENDS__ that is
+installed, and the full string to QaikuMessage decode path.
+
+Usage:
+    python benchmarks/json_codecs.py [-n 200] [-m 200]
+"""
+
+import optparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import qaiku
+
+def Timeline(count):
+    """
+    A public timeline page with count messages from 50 authors.
+    """
+    messages = []
+    for i in range(count):
+        author = 'user%d' % (i % 50)
+        messages.append({
+            'created_at': 'Thu, 15 Oct 2009 12:%02d:%02d +0000' % (i // 60 % 60, i % 60),
+            'id': '%032x' % (i * 7919),
+            'text': u'Message number %d, n\xe4r det g\xe5r s\xe5 bra #python' % i,
+            'html': u'Message number %d, n\xe4r det g\xe5r s\xe5 bra <a href="/c/python">#python</a>' % i,
+            'source': 'py-qaiku',
+            'lang': ('en', 'sv', 'fi')[i % 3],
+            'truncated': False,
+            'favorited': False,
+            'in_reply_to_status_id': i % 4 == 0 and '%032x' % (i * 31) or None,
+            'channel': i % 5 == 0 and 'python' or None,
+            'user': {'id': author,
+                     'name': author.title(),
+                     'screen_name': author,
+                     'location': 'Helsinki',
+                     'description': 'Just another qaikuer',
+                     'profile_image_url': 'http://www.qaiku.com/images/%s.png' % author,
+                     'url': 'http://example.com/%s' % author,
+                     'followers_count': i % 500,
+                     'created_at': 'Mon, 10 Aug 2009 10:00:00 +0000'}})
+    return messages
+
+def Best(stmt, number, repeat=5):
+    return min(timeit.repeat(stmt, number=number, repeat=repeat)) / number
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', dest='number', type='int', default=200,
+                      help='Runs per measurement.')
+    parser.add_option('-m', dest='messages', type='int', default=200,
+                      help='Messages per timeline page.')
+    options, args = parser.parse_args()
+
+    data = Timeline(options.messages)
+    print('%d messages, %d runs, times in ms per page' % (options.messages, options.number))
+    print('%-12s %10s %10s %12s %14s' % ('backend', 'loads', 'dumps', 'dumps sorted', 'to messages'))
+
+    for name in qaiku.__JSONBACKENDS__:
+        try:
+            codec = qaiku.QaikuJsonCodec(name)
+        except ImportError:
+            print('%-12s %10s' % (name, 'missing'))
+            continue
+
+        content = codec.Dumps(data)
+        qaiku.SetJsonCodec(codec)
+        client = qaiku.Qaiku('benchmark')
+
+        loads = Best(lambda: codec.Loads(content), options.number)
+        dumps = Best(lambda: codec.Dumps(data, sort_keys=False), options.number)
+        dumps_sorted = Best(lambda: codec.Dumps(data, sort_keys=True), options.number)
+        decode = Best(lambda: client._DecodeMessages(content), options.number)
+        print('%-12s %10.3f %10.3f %12.3f %14.3f' % (name, loads * 1000, dumps * 1000,
+                                                     dumps_sorted * 1000, decode * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Memory benchmark for the slotted model objects.
+
+Decodes a realistic timeline item into QaikuMessage/QaikuUser objects
+and compares the per object size with plain __dict__ based copies of the
+same classes, then builds many messages in a fresh interpreter per
+variant and reports the peak RSS.
+
+Usage:
+    python benchmarks/model_memory.py [-n 200000]
+"""
+
+import gc
+import optparse
+import os
+import resource
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import qaiku
+
+ITEM = {'created_at': 'Thu, 15 Oct 2009 12:00:00 +0000',
+        'id': 'a2d6d3bcb9d511de9d5bf79c3e2cc8c8c8c8',
+        'text': 'Reading the new timeline code, looks good so far',
+        'html': 'Reading the new timeline code, looks good so far',
+        'source': 'py-qaiku',
+        'lang': 'en',
+        'in_reply_to_status_id': 'f0e9bc4eb9d411dea3bd0fe1e6d7e1b0e1b0',
+        'channel': 'python',
+        'user': {'id': 'plux',
+                 'name': 'Mattias Stahre',
+                 'screen_name': 'plux',
+                 'location': 'Stockholm',
+                 'profile_image_url': 'http://www.qaiku.com/images/plux.png',
+                 'url': 'http://plux.se',
+                 'followers_count': 42,
+                 'created_at': 'Mon, 10 Aug 2009 10:00:00 +0000'}}
+
+def DictClass(cls):
+    """
+    A __dict__ based copy of a slotted model class.
+    """
+    return type('Dict' + cls.__name__, (object,),
+                {'__init__': cls.__dict__['__init__']})
+
+def Build(variant, count):
+    if variant == 'slots':
+        message_class, user_class = qaiku.QaikuMessage, qaiku.QaikuUser
+    else:
+        message_class, user_class = DictClass(qaiku.QaikuMessage), DictClass(qaiku.QaikuUser)
+
+    fields = dict(ITEM)
+    user_fields = fields.pop('user')
+    messages = []
+    for i in range(count):
+        user = user_class(**user_fields)
+        messages.append(message_class(user=user, **fields))
+    return messages
+
+def ObjectSize(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def PeakRss(variant, count):
+    """
+    Build count messages in a new interpreter and return its peak RSS in kB.
+    """
+    output = subprocess.Popen([sys.executable, __file__, '--child', variant,
+                               '-n', str(count)],
+                              stdout=subprocess.PIPE).communicate()[0]
+    return int(output.strip())
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', dest='count', type='int', default=200000)
+    parser.add_option('--child', dest='child', default=None)
+    options, args = parser.parse_args()
+
+    if options.child:
+        gc.disable()
+        messages = Build(options.child, options.count)
+        sys.stdout.write('%d\n' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        return
+
+    baseline = PeakRss('dict', 0)
+    print('%-8s %10s %10s %12s' % ('variant', 'message', 'user', 'peak rss kB'))
+    for variant in ('dict', 'slots'):
+        message = Build(variant, 1)[0]
+        rss = PeakRss(variant, options.count) - baseline
+        print('%-8s %10d %10d %12d' % (variant, ObjectSize(message),
+                                       ObjectSize(message.user), rss))
+    print('%d messages with one user each' % options.count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+A local HTTP server imitating the qaiku.com JSON API.
+
+Serves statuses/update, statuses/show, the timelines, search, replies,
+friends and followers with generated data. The messages form one reply
+tree, every message below thread_size has fanout replies. The users
+follow the page_size users after them and half of those follow back.
+Responses are gzipped for clients asking for it, unless compress is off. Every response can be delayed by a
+fixed latency and the list endpoints return page_size items, text_size
+characters of text per message. Responses carry an ETag so conditional
+requests can be benchmarked too. Fail and Truncate break the next
+responses on purpose, to exercise retries and the circuit breaker.
+
+Usage:
+    server = QaikuStubServer(latency=0.005, page_size=20)
+    server.Start()
+    qc = Qaiku(api_key="benchmark", base_url=server.base_url)
+    ...
+    server.Stop()
+
+    python benchmarks/stub_server.py --port 8080 --latency 0.01
+"""
+
+import BaseHTTPServer
+import SocketServer
+import gzip
+import json
+import optparse
+import threading
+import time
+import urlparse
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+TIMELINES = ('/api/statuses/friends_timeline.json',
+             '/api/statuses/user_timeline.json',
+             '/api/statuses/channel_timeline.json',
+             '/api/statuses/public_timeline.json',
+             '/api/statuses/mentions.json',
+             '/api/search.json')
+
+FRIENDS = '/api/statuses/friends.json'
+FOLLOWERS = '/api/statuses/followers.json'
+
+class QaikuStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Buffer the writes so headers and body leave in one segment, and
+    # do not let Nagle hold back the tail of large responses.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._Handle()
+
+    def do_POST(self):
+        self._Handle()
+
+    def _Handle(self):
+        server = self.server.stub
+        server._Count()
+        if server.latency:
+            time.sleep(server.latency)
+        status = server._Take('_failures')
+        if status:
+            return self._Send(status, {'error': 'Injected failure'})
+
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        path = url.path
+
+        if path == '/api/statuses/update.json':
+            length = int(self.headers.get('Content-Length', 0))
+            form = dict(urlparse.parse_qsl(self.rfile.read(length)))
+            message = server.Message(int(time.time() * 1000) % 1000000)
+            message['text'] = form.get('status', '')
+            message['lang'] = form.get('lang', 'en')
+            return self._Send(200, message)
+
+        if path.startswith('/api/statuses/show/') and path.endswith('.json'):
+            id = path[len('/api/statuses/show/'):-len('.json')]
+            try:
+                number = int(id, 16)
+            except ValueError:
+                return self._Send(404, {'error': 'Not found'})
+            return self._Send(200, server.Message(number), etag=id)
+
+        if path.startswith('/api/statuses/replies'):
+            if path == '/api/statuses/replies.json':
+                id = query.get('external_url', '').rsplit('/', 1)[-1]
+            else:
+                id = path[len('/api/statuses/replies/'):-len('.json')]
+            try:
+                number = int(id, 16)
+            except ValueError:
+                return self._Send(404, {'error': 'Not found'})
+            return self._Send(200, [server.Message(i) for i in server.Replies(number)])
+
+        if path in TIMELINES:
+            page = int(query.get('page', 1))
+            if page > server.pages:
+                return self._Send(200, [])
+            start = page * server.page_size
+            items = [server.Message(start + i) for i in range(server.page_size)]
+            return self._Send(200, items, etag='%s-%d' % (path, page))
+
+        if path in (FRIENDS, FOLLOWERS):
+            try:
+                number = int(query.get('user_id', 'user0')[len('user'):])
+            except ValueError:
+                return self._Send(404, {'error': 'Not found'})
+            if path == FRIENDS:
+                numbers = server.Friends(number)
+            else:
+                numbers = server.Followers(number)
+            return self._Send(200, [server.User(i) for i in numbers])
+
+        self._Send(404, {'error': 'Unknown endpoint'})
+
+    def _Send(self, status, body, etag=None):
+        if etag is not None:
+            etag = '"%s"' % etag
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                self.wfile.flush()
+                return
+
+        content = json.dumps(body)
+        gzipped = (self.server.stub.compress and
+                   'gzip' in self.headers.get('Accept-Encoding', ''))
+        if gzipped:
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6)
+            f.write(content)
+            f.close()
+            content = buf.getvalue()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        if isinstance(body, list) and self.server.stub._Take('_truncations'):
+            # Drop the connection halfway through the body.
+            content = content[:len(content) // 2]
+            self.close_connection = 1
+        self.wfile.write(content)
+        self.wfile.flush()
+
+class _ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+class QaikuStubServer:
+    """
+    The stub server, runs in a background thread.
+    """
+
+    def __init__(self,
+                 host='127.0.0.1',
+                 port=0,
+                 latency=0.0,
+                 page_size=20,
+                 pages=5,
+                 text_size=120,
+                 fanout=3,
+                 thread_size=200,
+                 users=1000,
+                 compress=True):
+        """
+        Args:
+            port: int 0 picks a free port.
+            latency: float Seconds every response is delayed.
+            page_size: int Items per list response.
+            pages: int Pages before a timeline runs empty.
+            text_size: int Characters of text per message.
+            fanout: int Replies to every message in the thread.
+            thread_size: int Messages in the reply tree.
+            users: int Users in the follow graph.
+            compress: bool Gzip responses when the client accepts it.
+        """
+        self.latency = latency
+        self.page_size = page_size
+        self.pages = pages
+        self.text_size = text_size
+        self.fanout = fanout
+        self.thread_size = thread_size
+        self.users = users
+        self.compress = compress
+        self.requests = 0
+        self._failures = []
+        self._truncations = []
+        self._lock = threading.Lock()
+        self._server = _ThreadedServer((host, port), QaikuStubHandler)
+        self._server.stub = self
+        self._thread = None
+        self.base_url = 'http://%s:%d/api' % self._server.server_address
+
+    def Start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def Stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def Message(self, number):
+        text = (u'Message %d n\xe4r det g\xe5r bra ' % number) * (self.text_size // 20 + 1)
+        return {'created_at': time.strftime('%a, %d %b %Y %H:%M:%S +0000',
+                                            time.gmtime(1255600000 - number * 60)),
+                'id': '%x' % number,
+                'text': text[:self.text_size],
+                'html': text[:self.text_size],
+                'source': 'stub',
+                'lang': ('en', 'sv', 'fi')[number % 3],
+                'in_reply_to_status_id': number > 0 and '%x' % ((number - 1) // self.fanout) or None,
+                'channel': number % 5 == 0 and 'python' or None,
+                'user': self.User(number % 50)}
+
+    def Replies(self, number):
+        first = number * self.fanout + 1
+        return range(first, min(first + self.fanout, self.thread_size))
+
+    def Friends(self, number):
+        return [(number + i) % self.users for i in range(1, self.page_size + 1)]
+
+    def Followers(self, number):
+        half = self.page_size // 2
+        return [(number + i) % self.users for i in range(-half, half + 1) if i]
+
+    def User(self, number):
+        return {'id': 'user%d' % number,
+                'name': 'User %d' % number,
+                'screen_name': 'user%d' % number,
+                'location': 'Helsinki',
+                'profile_image_url': 'http://www.qaiku.com/images/user%d.png' % number,
+                'followers_count': number * 3,
+                'created_at': 'Mon, 10 Aug 2009 10:00:00 +0000'}
+
+    def Fail(self, status, count=1):
+        """
+        Answer the next count requests with status.
+        """
+        self._lock.acquire()
+        self._failures.extend([status] * count)
+        self._lock.release()
+
+    def Truncate(self, count=1):
+        """
+        Cut the body of the next count list responses in half and close
+        the connection.
+        """
+        self._lock.acquire()
+        self._truncations.extend([True] * count)
+        self._lock.release()
+
+    def _Count(self):
+        self._lock.acquire()
+        self.requests += 1
+        self._lock.release()
+
+    def _Take(self, name):
+        self._lock.acquire()
+        try:
+            queue = getattr(self, name)
+            if queue:
+                return queue.pop(0)
+            return None
+        finally:
+            self._lock.release()
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--latency', type='float', default=0.0)
+    parser.add_option('--page-size', dest='page_size', type='int', default=20)
+    parser.add_option('--text-size', dest='text_size', type='int', default=120)
+    parser.add_option('--no-compress', dest='compress', action='store_false', default=True)
+    options, args = parser.parse_args()
+
+    server = QaikuStubServer(port=options.port,
+                             latency=options.latency,
+                             page_size=options.page_size,
+                             text_size=options.text_size,
+                             compress=options.compress)
+    print('Serving the stub API on %s' % server.base_url)
+    server._server.serve_forever()
+
+if __name__ == '__main__':
+    main()
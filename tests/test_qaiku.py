@@ -0,0 +1,202 @@
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Tests of the client against the local stub server in benchmarks.
+
+Usage:
+    python -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest("qaiku runs on Python 2.")
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import qaiku
+from stub_server import QaikuStubServer
+
+class FakeResponse(object):
+    """
+    Hands out a body a few bytes at a time, like a slow socket.
+    """
+
+    def __init__(self, body, size=7):
+        self.body = body
+        self.size = size
+        self.pos = 0
+
+    def read(self, amount):
+        chunk = self.body[self.pos:self.pos + self.size]
+        self.pos += len(chunk)
+        return chunk
+
+    def isclosed(self):
+        return self.pos >= len(self.body)
+
+class StubTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = QaikuStubServer(page_size=20, pages=2).Start()
+        self.base_url = self.server.base_url
+
+    def tearDown(self):
+        self.server.Stop()
+
+    def Client(self, **kwargs):
+        return qaiku.Qaiku('test', base_url=self.base_url, **kwargs)
+
+class AsyncTest(StubTestCase):
+
+    def testShowMessage(self):
+        aqc = qaiku.AsyncQaiku('test', base_url=self.base_url, max_concurrency=4)
+        ids = ['%x' % i for i in range(10)]
+        messages = qaiku.AsyncQaiku.Gather([aqc.ShowMessage(id) for id in ids])
+        self.assertEqual([message.id for message in messages], ids)
+
+    def testPage(self):
+        aqc = qaiku.AsyncQaiku('test', base_url=self.base_url)
+        self.assertEqual(len(aqc.GetPublicTimeLine().Result()), 20)
+
+class ShowMessagesTest(StubTestCase):
+
+    def testOrderDuplicatesAndErrors(self):
+        results = self.Client().ShowMessages(['1', '2', '1', None, 'zz'])
+        self.assertEqual(results[0].id, '1')
+        self.assertEqual(results[1].id, '2')
+        self.assertTrue(results[2] is results[0])
+        self.assertTrue(isinstance(results[3], qaiku.QaikuException))
+        self.assertTrue(isinstance(results[4], qaiku.QaikuHttpException))
+        self.assertEqual(results[4].code, 404)
+        self.assertEqual(self.server.requests, 3)
+
+class CacheTest(StubTestCase):
+
+    def testRevalidationReusesConnection(self):
+        metrics = qaiku.QaikuMetrics()
+        qc = self.Client(cache=qaiku.QaikuResponseCache(), pool_size=1, instrument=metrics)
+        pages = [qc.GetPublicTimeLine().Page() for i in range(3)]
+        self.assertTrue(pages[2] is pages[0])
+        self.assertEqual(qc.cache.Stats()['hits'], 2)
+        stats = metrics.Stats()['GetPublicTimeLine']
+        self.assertEqual(stats['statuses'], {200: 1, 304: 2})
+        self.assertEqual(stats['connect']['count'], 1)
+
+class StreamTest(StubTestCase):
+
+    def testStreamedMatchesBuffered(self):
+        for compress in (True, False):
+            self.server.compress = compress
+            streamed = list(self.Client().GetPublicTimeLine())
+            buffered = list(self.Client(stream=False).GetPublicTimeLine())
+            self.assertEqual(len(streamed), 40)
+            self.assertEqual([message.asDict() for message in streamed],
+                             [message.asDict() for message in buffered])
+
+    def testWrappedResults(self):
+        body = '{"count": 12345, "meta": {"results": [0]}, "results": [{"id": 1}, {"id": 2.5}], "after": 1}'
+        stream = qaiku._QaikuStream(FakeResponse(body), None, lambda complete: None)
+        self.assertEqual(list(qaiku._JsonItems(stream)), [{'id': 1}, {'id': 2.5}])
+
+    def testEndedEarly(self):
+        stream = qaiku._QaikuStream(FakeResponse('[{"id": 1}, {"id"'), None, lambda complete: None)
+        self.assertRaises(qaiku.QaikuTransportException, list, qaiku._JsonItems(stream))
+
+class RetryTest(StubTestCase):
+
+    def testTruncatedStreamIsRetried(self):
+        retry = qaiku.QaikuRetryPolicy(base_delay=0.01)
+        self.server.Truncate()
+        self.assertEqual(len(self.Client(retry=retry).GetPublicTimeLine().Page()), 20)
+        self.assertEqual(retry.Stats()['retries'], 1)
+        self.assertEqual(retry.Stats()['recovered'], 1)
+
+    def testServerErrorIsRetried(self):
+        retry = qaiku.QaikuRetryPolicy(base_delay=0.01)
+        self.server.Fail(503)
+        self.assertEqual(self.Client(retry=retry).ShowMessage('5').id, '5')
+        self.assertEqual(retry.Stats()['retries'], 1)
+
+    def testTruncationOpensBreaker(self):
+        breaker = qaiku.QaikuCircuitBreaker(failure_threshold=2)
+        qc = self.Client(breaker=breaker)
+        self.server.Truncate(2)
+        for i in range(2):
+            self.assertRaises(qaiku.QaikuTransportException, qc.GetPublicTimeLine().Page)
+        self.assertEqual(breaker.state, qaiku.QaikuCircuitBreaker.OPEN)
+
+    def testQuotaDoesNotOpenBreaker(self):
+        breaker = qaiku.QaikuCircuitBreaker(failure_threshold=2)
+        qc = self.Client(breaker=breaker)
+        self.server.Fail(429, 3)
+        for i in range(3):
+            self.assertRaises(qaiku.QaikuHttpException, qc.ShowMessage, '1')
+        self.assertEqual(breaker.state, qaiku.QaikuCircuitBreaker.CLOSED)
+        self.assertEqual(qc.ShowMessage('1').id, '1')
+
+class PostQueueTest(StubTestCase):
+
+    def setUp(self):
+        StubTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.spool = os.path.join(self.directory, 'posts.spool')
+
+    def tearDown(self):
+        StubTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def testCloseWithoutFlushKeepsPosts(self):
+        self.server.latency = 0.2
+        queue = qaiku.QaikuPostQueue(self.Client(), workers=1, spool=self.spool)
+        futures = [queue.Post('post %d' % i) for i in range(3)]
+        queue.Close(flush=False)
+        self.assertEqual(queue.sent, 1)
+        self.assertRaises(qaiku.QaikuException, futures[2].Result)
+
+        self.server.latency = 0
+        queue = qaiku.QaikuPostQueue(self.Client(), spool=self.spool)
+        texts = sorted(future.Result().text for future in queue.recovered)
+        self.assertEqual(texts, ['post 1', 'post 2'])
+        queue.Close()
+        self.assertEqual(os.path.getsize(self.spool), 0)
+
+    def testSpoolEmptiedWhenIdle(self):
+        queue = qaiku.QaikuPostQueue(self.Client(), spool=self.spool)
+        for i in range(10):
+            queue.Post('post %d' % i).Result()
+        queue.Flush()
+        self.assertEqual(os.path.getsize(self.spool), 0)
+        queue.Close()
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testCompactIsDurable(self):
+        archive = qaiku.QaikuArchive(self.directory)
+        archive.AddMessages([qaiku.QaikuMessage(id=str(i), text='message %d' % i)
+                             for i in range(100)])
+        archive.Rotate()
+        for i in range(25):
+            archive.Delete(str(i))
+        archive.Compact()
+        # Read the files back while the archive is still open, as after a crash.
+        reopened = qaiku.QaikuArchive(self.directory)
+        self.assertEqual(len(reopened), 75)
+        self.assertEqual(reopened.GetMessage('99').text, 'message 99')
+        reopened.Close()
+        archive.Close()
+
+if __name__ == '__main__':
+    unittest.main()